@@ -1,21 +1,32 @@
 import asyncio
+import heapq
 import time
 import re
-import io
 import random
+from collections import OrderedDict
 from typing import Dict
 
 from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
-import httpx
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
+import aiohttp
+import orjson
+import uvloop
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
 import os
+from contextlib import asynccontextmanager
+
 from dotenv import load_dotenv
 
+# ================= EVENT LOOP =================
+# uvloop roughly doubles asyncio throughput on this I/O-bound workload.
+# Installing the policy here covers both programmatic runs and
+# `uvicorn main:app --loop auto`.
+uvloop.install()
+
 # ================= LOAD ENV =================
 load_dotenv()
 
@@ -25,8 +36,12 @@ ACTOR_ID = os.getenv("ACTOR_ID")
 if not APIFY_TOKEN:
     raise ValueError("APIFY_TOKEN not found in environment variables")
 
-APIFY_RUN_URL = f"https://api.apify.com/v2/acts/{ACTOR_ID}/runs?token={APIFY_TOKEN}"
-APIFY_DATASET_URL = "https://api.apify.com/v2/datasets/{dataset_id}/items?token={token}"
+# run-sync-get-dataset-items blocks server-side until the actor finishes and
+# returns the dataset items directly — no run-status polling, no dataset fetch.
+APIFY_SYNC_URL = (
+    f"https://api.apify.com/v2/acts/{ACTOR_ID}/run-sync-get-dataset-items"
+    f"?token={APIFY_TOKEN}"
+)
 
 # ================= TELEGRAM (HARDCODED) =================
 TELEGRAM_BOT_TOKEN = "8495512623:AAF6lpsd0vAAfcbCABre05IJ_-_WAdzItYk"
@@ -34,14 +49,55 @@ TELEGRAM_CHAT_ID = "5029478739"
 
 # ================= SETTINGS =================
 REQUEST_TIMEOUT = 60
-POLL_INTERVAL = 1
 MAX_WAIT_TIME = 15
-CACHE_TTL = 300              # for successful profiles
-NOT_FOUND_CACHE_TTL = 300   # for "PROFILE_NOT_FOUND" responses (negative cache)
+# TTLs are env-tunable so they can be converged empirically against the
+# observed Apify call rate (STATS["apify_calls"]) instead of hardcoded.
+CACHE_TTL = int(os.getenv("CACHE_TTL", "300"))              # for successful profiles
+NOT_FOUND_CACHE_TTL = int(os.getenv("NOT_FOUND_CACHE_TTL", "300"))   # negative cache
+
+# Point this at redis (e.g. redis://localhost:6379) when running multiple
+# Uvicorn workers — in-process counters would otherwise give each worker its
+# own 30/minute budget.
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
+
+# ================= SHARED HTTP CLIENT =================
+# One pooled session for the whole process instead of a fresh client per
+# request, so TCP/TLS handshakes and DNS lookups are paid once and keep-alive
+# connections get reused across calls to Apify / Telegram. aiohttp's pool
+# also doesn't serialize concurrent requests the way httpcore's does.
+http_session: aiohttp.ClientSession = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_session
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=1000,
+            limit_per_host=100,
+            # aiodns-backed resolver: lookups run on the event loop instead of
+            # getaddrinfo in the threadpool, and api.apify.com /
+            # api.telegram.org resolutions stay cached for 10 minutes.
+            resolver=aiohttp.AsyncResolver(),
+            ttl_dns_cache=600,
+        ),
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+    )
+    app.state.http = http_session
+    cleanup_task = asyncio.create_task(cleanup_expired_cache())
+    alert_task = asyncio.create_task(flush_telegram_alerts())
+    yield
+    cleanup_task.cancel()
+    alert_task.cancel()
+    await http_session.close()
 
 # ================= RATE LIMIT =================
-limiter = Limiter(key_func=get_remote_address)
-app = FastAPI(title="Instagram Profile API", version="2.0.0")
+limiter = Limiter(key_func=get_remote_address, storage_uri=RATE_LIMIT_STORAGE_URI)
+app = FastAPI(
+    title="Instagram Profile API",
+    version="2.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
@@ -59,7 +115,11 @@ app.add_middleware(
     allow_origins=ALLOWED_ORIGINS,      # ONLY these origins can call
     allow_credentials=True,
     allow_methods=["GET"],               # only GET methods
-    allow_headers=["*"],
+    # Wildcard headers force a preflight on otherwise-simple GETs; naming the
+    # few we accept keeps plain requests preflight-free, and any preflight
+    # that does happen is cached by the browser for 24h.
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,
 )
 
 # ================= MIDDLEWARE TO BLOCK UNAUTHORIZED ORIGINS =================
@@ -95,14 +155,14 @@ async def block_unauthorized_origins(request: Request, call_next):
     
     # If no origin and no referer, it's likely a direct API call (curl, Postman, etc.)
     if not origin and not referer:
-        await notify_telegram(f"🚨 BLOCKED: Direct API call from IP {client_ip}")
+        notify_telegram(f"🚨 BLOCKED: Direct API call from IP {client_ip}")
         raise HTTPException(
             status_code=403, 
             detail="ACCESS_DENIED: This API can only be accessed from followerssupply.store"
         )
     
     if not is_allowed:
-        await notify_telegram(f"🚨 BLOCKED: Unauthorized origin {origin or 'no-origin'} from IP {client_ip}")
+        notify_telegram(f"🚨 BLOCKED: Unauthorized origin {origin or 'no-origin'} from IP {client_ip}")
         raise HTTPException(
             status_code=403,
             detail=f"ACCESS_DENIED: Origin '{origin}' is not allowed. Only followerssupply.store can access this API."
@@ -111,15 +171,59 @@ async def block_unauthorized_origins(request: Request, call_next):
     return await call_next(request)
 
 # ================= CACHE =================
-CACHE: Dict[str, dict] = {}
-STATS = {"hits": 0, "misses": 0, "last_alerts": []}
-LOCK = asyncio.Lock()
+CACHE: "OrderedDict[str, dict]" = OrderedDict()
+EXPIRY_HEAP: list = []      # (expiry, username), swept by the cleanup task
+STATS = {"hits": 0, "misses": 0, "apify_calls": 0, "last_alerts": []}
+INFLIGHT: Dict[str, asyncio.Task] = {}   # single-flight: one Apify fetch per username
+CLEANUP_INTERVAL = 30
+MAX_CACHE_SIZE = 10000      # LRU cap so a wide username spread can't blow up memory
+
+def cache_set(username: str, data, ttl: float):
+    expiry = time.time() + ttl
+    # Pay the JSON encoder once at write time; hits serve the bytes as-is.
+    body = orjson.dumps(data) if data is not None else None
+    CACHE[username] = {"data": data, "body": body, "expiry": expiry}
+    CACHE.move_to_end(username)
+    heapq.heappush(EXPIRY_HEAP, (expiry, username))
+    while len(CACHE) > MAX_CACHE_SIZE:
+        CACHE.popitem(last=False)   # drop least-recently-used
+
+def is_richer_profile(new: dict, old: dict) -> bool:
+    """
+    Conditional-update policy: only let a fresh scrape replace a cached
+    profile when it's at least as complete (Apify occasionally returns
+    partial records with missing counts).
+    """
+    for key in ("followers", "following", "post_count"):
+        new_val = new.get(key)
+        old_val = old.get(key)
+        if new_val is None and old_val is not None:
+            return False
+    return True
+
+async def cleanup_expired_cache():
+    """
+    Evict expired entries so the cache doesn't grow until restart.
+    The min-heap keeps cleanup at O(k) per sweep (k = entries actually
+    expired) instead of scanning the whole dict.
+    """
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL)
+        now = time.time()
+        while EXPIRY_HEAP and EXPIRY_HEAP[0][0] < now:
+            expiry, username = heapq.heappop(EXPIRY_HEAP)
+            entry = CACHE.get(username)
+            # Only drop the entry if it wasn't refreshed since this push.
+            if entry and entry["expiry"] == expiry:
+                CACHE.pop(username, None)
 
 # ================= TELEGRAM =================
-async def notify_telegram(message: str):
-    STATS["last_alerts"].append({"time": time.time(), "msg": message})
-    STATS["last_alerts"] = STATS["last_alerts"][-10:]
+_ALERT_BUFFER: list = []
+_ALERT_MAX_BUFFER = 1000    # cap so an incident can't grow the buffer unboundedly
+_ALERT_BATCH_SIZE = 50      # max messages joined into one Telegram post
+ALERT_FLUSH_INTERVAL = 5
 
+async def _send_telegram(message: str):
     telegram_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
 
     payload = {
@@ -128,97 +232,112 @@ async def notify_telegram(message: str):
     }
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            await client.post(telegram_url, json=payload)
+        async with http_session.post(
+            telegram_url, json=payload, timeout=aiohttp.ClientTimeout(total=10.0)
+        ):
+            pass
     except Exception as e:
         print("Telegram send failed:", str(e))
 
+def notify_telegram(message: str):
+    """
+    Fire-and-forget: the alert is buffered and the background flusher sends
+    the batch, so an Apify outage produces one coalesced Telegram post every
+    few seconds instead of one API call per failing request.
+    """
+    STATS["last_alerts"].append({"time": time.time(), "msg": message})
+    STATS["last_alerts"] = STATS["last_alerts"][-10:]
+
+    if len(_ALERT_BUFFER) < _ALERT_MAX_BUFFER:
+        _ALERT_BUFFER.append(message)
+
+async def flush_telegram_alerts():
+    while True:
+        await asyncio.sleep(ALERT_FLUSH_INTERVAL)
+        if not _ALERT_BUFFER:
+            continue
+        batch = _ALERT_BUFFER[:_ALERT_BATCH_SIZE]
+        del _ALERT_BUFFER[:_ALERT_BATCH_SIZE]
+        await _send_telegram("\n".join(batch))
+
 # ================= UTILS =================
+# re.ASCII keeps the pattern free of Unicode tables; the length check below
+# rejects oversize input before the regex engine is ever invoked.
+_USERNAME_RE = re.compile(r"\A[a-zA-Z0-9._]+\Z", re.ASCII)
+
 def validate_username(username: str) -> bool:
-    return bool(re.match(r"^[a-zA-Z0-9._]{1,30}$", username))
+    return 1 <= len(username) <= 30 and _USERNAME_RE.match(username) is not None
+
+_USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X)",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7)",
+)
+_BASE_HEADERS = {
+    "Referer": "https://www.instagram.com/",
+    "Accept": "image/webp,image/apng,image/*,*/*;q=0.8",
+}
 
 def get_random_headers():
-    user_agents = [
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
-        "Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X)",
-        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7)",
-    ]
     return {
-        "User-Agent": random.choice(user_agents),
-        "Referer": "https://www.instagram.com/",
-        "Accept": "image/webp,image/apng,image/*,*/*;q=0.8",
+        **_BASE_HEADERS,
+        "User-Agent": _USER_AGENTS[random.randrange(len(_USER_AGENTS))],
     }
 
+# (output key, Apify key) pairs — walked with one bound .get per profile
+_FIELD_MAP = (
+    ("username", "username"),
+    ("real_name", "fullName"),
+    ("profile_pic", "profilePicUrl"),
+    ("followers", "followersCount"),
+    ("following", "followsCount"),
+    ("post_count", "postsCount"),
+    ("bio", "biography"),
+)
+
 def format_profile(profile: dict) -> dict:
-    return {
-        "username": profile.get("username"),
-        "real_name": profile.get("fullName"),
-        "profile_pic": profile.get("profilePicUrl"),
-        "followers": profile.get("followersCount"),
-        "following": profile.get("followsCount"),
-        "post_count": profile.get("postsCount"),
-        "bio": profile.get("biography"),
-    }
+    g = profile.get
+    return {out: g(src) for out, src in _FIELD_MAP}
 
 # ================= SCRAPER =================
 async def fetch_from_apify(username: str) -> dict:
-    async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-        payload = {"usernames": [username]}
+    STATS["apify_calls"] += 1
+    payload = {"usernames": [username]}
 
-        try:
-            run_res = await client.post(APIFY_RUN_URL, json=payload)
-        except Exception as e:
-            await notify_telegram(f"🚨 APIFY UNREACHABLE\n@{username}\n{str(e)}")
-            raise HTTPException(503, "APIFY_UNREACHABLE")
-
-        if run_res.status_code != 201:
-            await notify_telegram(f"⚠ APIFY RUN FAILED\n@{username}\nHTTP {run_res.status_code}")
-            raise HTTPException(502, "APIFY_RUN_FAILED")
-
-        run_data = run_res.json()
-        run_id = run_data["data"]["id"]
-        dataset_id = run_data["data"]["defaultDatasetId"]
-
-        status_url = f"https://api.apify.com/v2/actor-runs/{run_id}?token={APIFY_TOKEN}"
-        elapsed = 0
-
-        while elapsed < MAX_WAIT_TIME:
-            status_res = await client.get(status_url)
-            status = status_res.json()["data"]["status"]
-
-            if status == "SUCCEEDED":
-                break
-
-            if status in ["FAILED", "ABORTED", "TIMED-OUT"]:
-                await notify_telegram(f"⚠ APIFY RUN FAILED\n@{username}\nStatus: {status}")
-                raise HTTPException(502, "APIFY_RUN_FAILED")
+    try:
+        async with http_session.post(
+            APIFY_SYNC_URL,
+            json=payload,
+            timeout=aiohttp.ClientTimeout(total=MAX_WAIT_TIME),
+        ) as run_res:
+            run_status = run_res.status
+            items = orjson.loads(await run_res.read()) if run_status == 201 else None
+    except asyncio.TimeoutError:
+        notify_telegram(f"⏳ APIFY TIMEOUT\n@{username}")
+        raise HTTPException(504, "APIFY_TIMEOUT")
+    except Exception as e:
+        notify_telegram(f"🚨 APIFY UNREACHABLE\n@{username}\n{str(e)}")
+        raise HTTPException(503, "APIFY_UNREACHABLE")
 
-            await asyncio.sleep(POLL_INTERVAL)
-            elapsed += POLL_INTERVAL
-        else:
-            await notify_telegram(f"⏳ APIFY TIMEOUT\n@{username}")
-            raise HTTPException(504, "APIFY_TIMEOUT")
+    if run_status == 408:
+        notify_telegram(f"⏳ APIFY TIMEOUT\n@{username}")
+        raise HTTPException(504, "APIFY_TIMEOUT")
 
-        dataset_url = APIFY_DATASET_URL.format(dataset_id=dataset_id, token=APIFY_TOKEN)
-        data_res = await client.get(dataset_url)
+    if run_status != 201:
+        notify_telegram(f"⚠ APIFY RUN FAILED\n@{username}\nHTTP {run_status}")
+        raise HTTPException(502, "APIFY_RUN_FAILED")
 
-        if data_res.status_code != 200:
-            await notify_telegram(f"⚠ DATASET FETCH FAILED\n@{username}")
-            raise HTTPException(502, "DATASET_FETCH_FAILED")
+    if not items:
+        notify_telegram(f"❌ PROFILE NOT FOUND\n@{username}")
+        raise HTTPException(404, "PROFILE_NOT_FOUND")
 
-        items = data_res.json()
+    profile = items[0]
 
-        if not items:
-            await notify_telegram(f"❌ PROFILE NOT FOUND\n@{username}")
-            raise HTTPException(404, "PROFILE_NOT_FOUND")
+    if profile.get("error") == "not_found":
+        notify_telegram(f"❌ PROFILE NOT FOUND\n@{username}")
+        raise HTTPException(404, "PROFILE_NOT_FOUND")
 
-        profile = items[0]
-
-        if profile.get("error") == "not_found":
-            await notify_telegram(f"❌ PROFILE NOT FOUND\n@{username}")
-            raise HTTPException(404, "PROFILE_NOT_FOUND")
-
-        return profile
+    return profile
 
 # ================= MAIN SCRAPE =================
 @app.get("/scrape/{username}")
@@ -228,62 +347,86 @@ async def get_user(username: str, request: Request):
         raise HTTPException(400, "INVALID_USERNAME")
 
     # --- Check cache (positive + negative) ---
-    async with LOCK:
-        cached = CACHE.get(username)
-        if cached and cached["expiry"] > time.time():
-            STATS["hits"] += 1
-            if cached["data"] is None:          # cached "not found"
-                raise HTTPException(404, "PROFILE_NOT_FOUND")
-            return cached["data"]               # cached valid profile
+    # Lock-free read: dict get is atomic under the GIL, so cache hits don't
+    # have to queue behind a single asyncio.Lock. Expiry is handled entirely
+    # by the background sweep, so presence alone means the entry is live
+    # (stale by at most CLEANUP_INTERVAL past its TTL).
+    cached = CACHE.get(username)
+    if cached:
+        CACHE.move_to_end(username)     # mark as recently used
+        STATS["hits"] += 1
+        if cached["data"] is None:          # cached "not found"
+            raise HTTPException(404, "PROFILE_NOT_FOUND")
+        # Serve the bytes encoded at write time — no per-hit JSON encoding
+        return Response(content=cached["body"], media_type="application/json")
 
     STATS["misses"] += 1
 
+    # --- Single-flight: concurrent misses for the same username share one
+    # Apify run instead of each starting their own 15s poll loop ---
+    task = INFLIGHT.get(username)
+    if task is None:
+        task = asyncio.create_task(fetch_from_apify(username))
+        INFLIGHT[username] = task
+        task.add_done_callback(lambda _: INFLIGHT.pop(username, None))
+
     try:
-        raw_profile = await fetch_from_apify(username)
+        raw_profile = await asyncio.shield(task)
     except HTTPException as e:
         # --- Cache 404 responses so we don't hammer Apify again ---
         if e.status_code == 404:
-            async with LOCK:
-                CACHE[username] = {
-                    "data": None,
-                    "expiry": time.time() + NOT_FOUND_CACHE_TTL
-                }
+            cache_set(username, None, NOT_FOUND_CACHE_TTL)
         raise   # re-raise the same exception to the client
 
     # Success – cache the formatted profile
     formatted = format_profile(raw_profile)
-    async with LOCK:
-        CACHE[username] = {
-            "data": formatted,
-            "expiry": time.time() + CACHE_TTL
-        }
+    cached = CACHE.get(username)
+    if cached and cached["data"] and not is_richer_profile(formatted, cached["data"]):
+        # New scrape came back thinner than what we hold; keep the cached
+        # record and just refresh its TTL.
+        cache_set(username, cached["data"], CACHE_TTL)
+    else:
+        cache_set(username, formatted, CACHE_TTL)
 
-    return formatted
+    return Response(content=CACHE[username]["body"], media_type="application/json")
 
 # ================= PROXY IMAGE =================
 @app.get("/proxy-image/")
 @limiter.limit("50/minute")
 async def proxy_image(request: Request, url: str = Query(...)):
+    headers = get_random_headers()
+
     try:
-        headers = get_random_headers()
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.get(url, headers=headers)
+        resp = await http_session.get(
+            url, headers=headers, timeout=aiohttp.ClientTimeout(total=10.0)
+        )
+    except Exception as e:
+        notify_telegram(f"🚨 PROXY IMAGE ERROR\n{url}\n{str(e)}")
+        raise HTTPException(502, "IMAGE_FETCH_FAILED")
 
-        if resp.status_code == 200:
-            return StreamingResponse(
-                io.BytesIO(resp.content),
-                media_type=resp.headers.get("content-type", "image/jpeg")
-            )
+    if resp.status != 200:
+        status = resp.status
+        resp.release()
 
-        if resp.status_code == 404:
+        if status == 404:
             raise HTTPException(404, "Image not found")
 
-        await notify_telegram(f"⚠ IMAGE FETCH FAILED\n{url}\nHTTP {resp.status_code}")
+        notify_telegram(f"⚠ IMAGE FETCH FAILED\n{url}\nHTTP {status}")
         raise HTTPException(502, "IMAGE_FETCH_FAILED")
 
-    except Exception as e:
-        await notify_telegram(f"🚨 PROXY IMAGE ERROR\n{url}\n{str(e)}")
-        raise HTTPException(502, "IMAGE_FETCH_FAILED")
+    # Stream the image through in 64KB chunks instead of buffering the whole
+    # body in RAM; the response is held open until the generator finishes.
+    async def stream_chunks():
+        try:
+            async for chunk in resp.content.iter_chunked(65536):
+                yield chunk
+        finally:
+            resp.release()
+
+    return StreamingResponse(
+        stream_chunks(),
+        media_type=resp.headers.get("content-type", "image/jpeg")
+    )
 
 # ================= HEALTH =================
 @app.get("/health")